@@ -5,46 +5,96 @@
     Author: Ali Toori, Python Developer
     *******************************************************************************************
 """
+import atexit
+import contextlib
+import csv
 import json
 import logging.config
+import logging.handlers
+import math
+import multiprocessing
 import os
-import pickle
 import random
 from datetime import datetime
 from multiprocessing import freeze_support
 from pathlib import Path
-from time import sleep
 import concurrent.futures
 
-import pandas as pd
 import pyfiglet
 from selenium import webdriver
-from selenium.common.exceptions import WebDriverException
-from selenium.webdriver import Keys
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
+SEL_ADDR_NAME = '[data-testid="collection-title"], h1'
+SEL_ASSET_ANCHOR = 'a.Asset--anchor'
+SEL_TILE_COLLECTION = '[data-testid="ItemCardFooter-name"]'
+SEL_TILE_PRICE = '.Price--fiat-amount'
+SEL_TILE_COLLECTION_LINK = 'a[href^="/collection/"]'
+SEL_COLLECTION_LINK = 'a.CollectionLink--link'
+SEL_BEST_OFFER = '.Price--fiat-amount-secondary'
+
+# Collection page fields, selectors are passed in as arguments[0..4], null until the first asset renders.
+# Missing fields are returned as null, chromedriver drops undefined properties from the result
+JS_ADDRESS_DETAILS = """
+    const anchor = document.querySelector(arguments[1]);
+    if (!anchor) return null;
+    const tile = anchor?.closest('article');
+    return {
+        name: document.querySelector(arguments[0])?.innerText ?? null,
+        collection: tile?.querySelector(arguments[2])?.innerText ?? null,
+        url: anchor.href,
+        best: tile?.querySelector(arguments[3])?.innerText ?? null,
+        collection_name: tile?.querySelector(arguments[4])?.innerText ?? null
+    };
+"""
+
+# Asset page fields, selectors are passed in as arguments[0..1], null until the collection link renders
+JS_ASSET_DETAILS = """
+    const link = document.querySelector(arguments[0]);
+    if (!link) return null;
+    return {
+        collection_name: link.innerText,
+        best: document.querySelector(arguments[1])?.innerText ?? null
+    };
+"""
+
 
 class OpenSeaBot:
-    def __init__(self):
+    def __init__(self, log_queue=None, valid_lock=None):
         self.PROJECT_ROOT = Path(os.path.abspath(os.path.dirname(__file__)))
         self.file_settings = str(self.PROJECT_ROOT / 'BotRes/Settings.json')
         self.file_addresses = self.PROJECT_ROOT / 'BotRes/Addresses.csv'
         self.file_valid = self.PROJECT_ROOT / 'BotRes/Valid.csv'
+        self.VALID_FIELDS = ["TodaysDate", "ScanAddress", "CollectionName", "Collection", "AssetNumber", "BestOffer", "Premium"]
         self.OPENSEA_HOME_URL = "https://opensea.io/"
+        # CDP patterns match the whole URL, the trailing * also covers CDN query strings like .png?w=500
+        self.BLOCKED_URLS = ["*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.svg*", "*.woff*", "*.ttf*", "*.mp4*", "*.webm*", "*.css*"]
         self.settings = self.get_settings()
-        self.LOGGER = self.get_logger()
+        self.LOGGER = self.get_logger(log_queue=log_queue)
+        self._uagents = self.load_list(self.PROJECT_ROOT / 'BotRes/user_agents.txt')
+        self._proxies = self.load_list(self.PROJECT_ROOT / 'BotRes/proxies.txt')
         self.driver = None
+        self.FLUSH_EVERY = 25
+        self._pending = []
+        # Shared with the other workers so only one process appends to Valid.csv at a time
+        self.valid_lock = valid_lock or contextlib.nullcontext()
+        atexit.register(self._flush)
 
     # Get self.LOGGER
     @staticmethod
-    def get_logger():
+    def get_logger(log_queue=None):
         """
-        Get logger file handler
+        Get logger file handler, worker processes hand their records to the main process through log_queue
         :return: LOGGER
         """
+        if log_queue is not None:
+            logger = logging.getLogger()
+            logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+            logger.setLevel(logging.INFO)
+            return logger
         logging.config.dictConfig({
             "version": 1,
             "disable_existing_loggers": False,
@@ -113,29 +163,24 @@ class OpenSeaBot:
                 settings = json.load(f)
             return settings
         settings = {"Settings": {
-            "ThreadsCount": 5
+            "ThreadCount": 5
         }}
         with open(self.file_settings, 'w') as f:
             json.dump(settings, f, indent=4)
-        with open(self.file_settings, 'r') as f:
-            settings = json.load(f)
         return settings
 
+    # Load user-agents and proxies once, they are picked from memory on every driver launch
+    @staticmethod
+    def load_list(file_path):
+        return [line for line in map(str.strip, file_path.read_text().splitlines()) if line]
+
     # Get random user-agent
     def get_user_agent(self):
-        file_uagents = self.PROJECT_ROOT / 'BotRes/user_agents.txt'
-        with open(file_uagents) as f:
-            content = f.readlines()
-        u_agents_list = [x.strip() for x in content]
-        return random.choice(u_agents_list)
+        return random.choice(self._uagents)
 
-    # Get random user-agent
+    # Get random proxy
     def get_proxy(self):
-        file_proxies = self.PROJECT_ROOT / 'BotRes/proxies.txt'
-        with open(file_proxies) as f:
-            content = f.readlines()
-        proxy_list = [x.strip() for x in content]
-        proxy = random.choice(proxy_list)
+        proxy = random.choice(self._proxies)
         self.LOGGER.info(f'Proxy selected: {proxy}')
         return proxy
 
@@ -144,6 +189,8 @@ class OpenSeaBot:
         driver_bin = str(self.PROJECT_ROOT / "BotRes/bin/chromedriver.exe")
         service = Service(executable_path=driver_bin)
         options = webdriver.ChromeOptions()
+        # Return from driver.get() once the DOM is ready, the explicit waits cover the rendered elements
+        options.page_load_strategy = 'eager'
         options.add_argument("--start-maximized")
         options.add_argument("--disable-extensions")
         options.add_argument("--disable-notifications")
@@ -159,102 +206,198 @@ class OpenSeaBot:
         options.add_experimental_option("excludeSwitches", ["enable-automation"])
         options.add_experimental_option('useAutomationExtension', False)
         prefs = {"profile.default_content_setting_values.geolocation": 2,
-                 "profile.managed_default_content_setting_values.images": 2}
+                 "profile.managed_default_content_setting_values.images": 2,
+                 "profile.managed_default_content_setting_values.javascript": 1,
+                 "profile.managed_default_content_setting_values.plugins": 2,
+                 "profile.managed_default_content_setting_values.popups": 2,
+                 "profile.managed_default_content_setting_values.media_stream": 2}
         options.add_experimental_option("prefs", prefs)
         options.add_argument(F'--user-agent={self.get_user_agent()}')
         if proxy:
             options.add_argument(f"--proxy-server={self.get_proxy()}")
         if headless:
-            options.add_argument('--headless')
+            # --start-maximized is ignored headless, size the window so OpenSea serves the desktop layout
+            options.add_argument('--headless=new')
+            options.add_argument('--window-size=1920,1080')
         driver = webdriver.Chrome(service=service, options=options)
+        # Explicit waits only, an implicit wait would stack on top of every poll
+        driver.implicitly_wait(0)
+        driver.set_page_load_timeout(20)
+        driver.set_script_timeout(10)
+        driver._waits = {(5, 0.5): WebDriverWait(driver, 5, 0.5), (10, 0.5): WebDriverWait(driver, 10, 0.5)}
+        # Only text is scraped, so skip downloading images, fonts, media and stylesheets
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": self.BLOCKED_URLS})
         return driver
 
+    # Start the next address with fresh cookies and user-agent instead of relaunching the browser
+    def reset_session(self, driver):
+        driver.delete_all_cookies()
+        driver.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": self.get_user_agent()})
+
     # Finish and quit browser
     def finish(self, driver):
+        if driver is None:
+            return
+        self.LOGGER.info(f'Closing browser')
         try:
-            self.LOGGER.info(f'Closing browser')
             driver.close()
-            driver.quit()
         except WebDriverException as exc:
             self.LOGGER.info(f'Issue while closing browser: {exc.args}')
+        # close() fails on a dead session, quit() still has to run to stop chromedriver
+        try:
+            driver.quit()
+        except WebDriverException as exc:
+            self.LOGGER.info(f'Issue while quitting browser: {exc.args}')
+
+    # Replace a crashed browser, returns False if Chrome could not be started again
+    def relaunch_driver(self):
+        self.finish(driver=self.driver)
+        self.driver = None
+        try:
+            self.driver = self.get_driver(proxy=True, headless=True)
+        except WebDriverException as exc:
+            self.LOGGER.info(f'Could not relaunch browser: {exc.msg}')
+            return False
+        return True
+
+    @staticmethod
+    def get_wait(driver, duration=10, frequency=0.5):
+        # Reuse the waiters built in get_driver, only build one for unusual duration/frequency pairs
+        waits = getattr(driver, '_waits', None)
+        if waits is None:
+            waits = driver._waits = {}
+        wait = waits.get((duration, frequency))
+        if wait is None:
+            wait = waits[(duration, frequency)] = WebDriverWait(driver, duration, frequency)
+        return wait
 
     @staticmethod
-    def wait_until_visible(driver, css_selector=None, element_id=None, name=None, class_name=None, tag_name=None, duration=10000, frequency=0.01):
+    def wait_until_visible(driver, css_selector=None, element_id=None, name=None, class_name=None, tag_name=None, duration=10, frequency=0.5):
+        wait = OpenSeaBot.get_wait(driver=driver, duration=duration, frequency=frequency)
         if css_selector:
-            WebDriverWait(driver, duration, frequency).until(EC.visibility_of_element_located((By.CSS_SELECTOR, css_selector)))
+            wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, css_selector)))
         elif element_id:
-            WebDriverWait(driver, duration, frequency).until(EC.visibility_of_element_located((By.ID, element_id)))
+            wait.until(EC.visibility_of_element_located((By.ID, element_id)))
         elif name:
-            WebDriverWait(driver, duration, frequency).until(EC.visibility_of_element_located((By.NAME, name)))
+            wait.until(EC.visibility_of_element_located((By.NAME, name)))
         elif class_name:
-            WebDriverWait(driver, duration, frequency).until(
-                EC.visibility_of_element_located((By.CLASS_NAME, class_name)))
+            wait.until(EC.visibility_of_element_located((By.CLASS_NAME, class_name)))
         elif tag_name:
-            WebDriverWait(driver, duration, frequency).until(EC.visibility_of_element_located((By.TAG_NAME, tag_name)))
+            wait.until(EC.visibility_of_element_located((By.TAG_NAME, tag_name)))
 
-    def get_address_details(self, addresses):
+    # Poll a script until it returns a result, waiting and reading fields in the same round-trip
+    def wait_until_script(self, driver, script, *args, duration=10, frequency=0.5):
+        return self.get_wait(driver=driver, duration=duration, frequency=frequency).until(lambda d: d.execute_script(script, *args))
+
+    # Scrape stats of a single address, returns None if it has no collection
+    def get_address_stats(self, driver, address):
         url_filter = '?search[sortBy]=UNIT_PRICE&search[sortAscending]=false'
-        # driver = self.get_driver(proxy=True, headless=False)
-        counter = 0
-        for i, address in enumerate(addresses):
-            counter += 1
-            driver = self.get_driver(proxy=True, headless=False)
-            # if counter >= 10:
-            #     counter = 0
-            #     self.finish(driver=driver)
-            #     driver = self.get_driver(proxy=False, headless=False)
-            final_url = self.OPENSEA_HOME_URL + address + url_filter
-            self.LOGGER.info(f"Scraping stats of {i}: {address}, URL: {final_url}")
-            # driver = self.get_driver(proxy=False, headless=False)
-            driver.get(final_url)
-            self.LOGGER.info(f"Waiting for OpenSea to load")
-            collection, collection_name, best_offer, premium = '', '', '', ''
-            # key = input(f'Enter a Key')
-            # if key == 'n':
-            #     continue
-            try:
-                self.wait_until_visible(driver=driver, css_selector='[class="sc-29427738-0 sc-bdnxRM dKfiYh iIKkrq"]', duration=10)
-                address_name = driver.find_element(By.CSS_SELECTOR, '[class="sc-29427738-0 sc-bdnxRM dKfiYh iIKkrq"]').text
-                if 'Unnamed' not in address_name:
-                    premium = 'Y'
-            except:
-                pass
-            try:
-                self.wait_until_visible(driver=driver, css_selector='[class="sc-1f719d57-0 fKAlPV Asset--anchor"]', duration=10)
-            except:
-                self.LOGGER.info(f"No collection found")
-                continue
-            try:
-                collection = str(driver.find_element(By.CSS_SELECTOR, '[class="sc-29427738-0 sc-d0e902a1-3 sc-21df3ef5-6 sc-ec8f13a5-5 eLucQB hVPIAI kixOOB"]').text).replace('"', '')
-            except:
-                pass
-            asset_url = driver.find_element(By.CSS_SELECTOR, '[class="sc-1f719d57-0 fKAlPV Asset--anchor"]').get_attribute('href')
+        final_url = self.OPENSEA_HOME_URL + address + url_filter
+        self.LOGGER.info(f"Scraping stats of {address}, URL: {final_url}")
+        driver.get(final_url)
+        self.LOGGER.info(f"Waiting for OpenSea to load")
+        collection, collection_name, best_offer, premium = '', '', '', ''
+        # Read every field in a single round-trip to chromedriver
+        try:
+            details = self.wait_until_script(driver, JS_ADDRESS_DETAILS, SEL_ADDR_NAME, SEL_ASSET_ANCHOR, SEL_TILE_COLLECTION,
+                                             SEL_TILE_PRICE, SEL_TILE_COLLECTION_LINK, duration=10)
+        except TimeoutException:
+            self.LOGGER.info(f"No collection found")
+            return None
+        if details.get("name") and 'Unnamed' not in details.get("name"):
+            premium = 'Y'
+        collection = str(details.get("collection") or '').replace('"', '')
+        asset_url = details["url"]
+        # The listing tile already carries the price and collection, read them there to skip the asset page
+        best_offer = details.get("best") or ''
+        collection_name = details.get("collection_name") or ''
+        if not best_offer:
             driver.get(asset_url)
             self.LOGGER.info(f"Waiting for stats to load")
             try:
-                self.wait_until_visible(driver=driver, css_selector='[class="sc-1f719d57-0 fKAlPV CollectionLink--link"]', duration=5)
-            except:
-                continue
-            try:
-                collection_name = str(driver.find_element(By.CSS_SELECTOR, '[class="sc-1f719d57-0 fKAlPV CollectionLink--link"]').text)
-            except:
-                pass
-            try:
-                best_offer = driver.find_element(By.CSS_SELECTOR, '[class="sc-1a668f09-0 UitxP Price--fiat-amount Price--fiat-amount-secondary"]').text
-            except:
-                pass
-            asset_number = asset_url.split('/')[-1]
-            stats = {"TodaysDate": datetime.now().strftime("%m-%d-%Y"), "ScanAddress": address, "CollectionName": collection_name,
-                     "Collection": collection, "AssetNumber": asset_number, "BestOffer": best_offer, "Premium": premium}
-            self.LOGGER.info(f'Stats: {str(stats)}')
-            df_following = pd.DataFrame([stats])
-            # if file does not exist write headers
-            if not os.path.isfile(self.file_valid):
-                df_following.to_csv(self.file_valid, index=False, sep='|')
-            else:  # else if exists so append without writing the header
-                df_following.to_csv(self.file_valid, mode='a', header=False, index=False, sep='|')
-            self.LOGGER.info(f"Stats have been saved to {self.file_valid}")
-            self.finish(driver=driver)
+                details = self.wait_until_script(driver, JS_ASSET_DETAILS, SEL_COLLECTION_LINK, SEL_BEST_OFFER, duration=5)
+            except TimeoutException:
+                return None
+            collection_name = details.get("collection_name") or ''
+            best_offer = details.get("best") or ''
+        asset_number = asset_url.split('/')[-1]
+        return {"TodaysDate": datetime.now().strftime("%m-%d-%Y"), "ScanAddress": address, "CollectionName": collection_name,
+                "Collection": collection, "AssetNumber": asset_number, "BestOffer": best_offer, "Premium": premium}
+
+    def get_address_details(self, driver, addresses):
+        self.driver = driver
+        try:
+            for i, address in enumerate(addresses):
+                # A failed relaunch leaves no driver, try again before each remaining address
+                if self.driver is None and not self.relaunch_driver():
+                    self.LOGGER.info(f'Skipping {address}, no browser available')
+                    continue
+                # A hung page only costs this address, the worker moves on to the next one
+                try:
+                    if i > 0:
+                        self.reset_session(driver=self.driver)
+                    stats = self.get_address_stats(driver=self.driver, address=address)
+                except WebDriverException as exc:
+                    if self.is_session_alive(driver=self.driver):
+                        self.LOGGER.info(f'Skipping {address}, page did not respond: {exc.msg}')
+                        try:
+                            self.driver.execute_script("window.stop()")
+                        except WebDriverException:
+                            pass
+                        continue
+                    # Chrome is gone, relaunch it and give this address one more try on the new session
+                    self.LOGGER.info(f'Browser session lost on {address}, relaunching: {exc.msg}')
+                    if not self.relaunch_driver():
+                        self.LOGGER.info(f'Skipping {address}, no browser available')
+                        continue
+                    try:
+                        stats = self.get_address_stats(driver=self.driver, address=address)
+                    except WebDriverException as exc:
+                        self.LOGGER.info(f'Skipping {address}: {exc.msg}')
+                        continue
+                if stats is None:
+                    continue
+                self.LOGGER.info(f'Stats: {str(stats)}')
+                self._pending.append(stats)
+                if len(self._pending) >= self.FLUSH_EVERY:
+                    self._flush()
+        finally:
+            self._flush()
+
+    # Check whether the browser behind the driver still answers
+    @staticmethod
+    def is_session_alive(driver):
+        try:
+            driver.execute_script("return 1")
+            return True
+        except TimeoutException:
+            return True
+        except WebDriverException:
+            return False
+
+    # Create Valid.csv with headers, called once from main before any worker starts appending
+    def create_valid_file(self):
+        if os.path.isfile(self.file_valid):
+            return
+        with open(self.file_valid, 'w', newline='', encoding='utf-8') as f:
+            csv.DictWriter(f, fieldnames=self.VALID_FIELDS, delimiter='|').writeheader()
+
+    # Append buffered stats to Valid.csv
+    def _flush(self):
+        if not self._pending:
+            return
+        with self.valid_lock, open(self.file_valid, 'a', newline='', encoding='utf-8') as f:
+            csv.DictWriter(f, fieldnames=self.VALID_FIELDS, delimiter='|').writerows(self._pending)
+        self.LOGGER.info(f"{len(self._pending)} stats have been saved to {self.file_valid}")
+        self._pending = []
+
+    # Get addresses already saved to Valid.csv on the given date, lowercased for case-insensitive matching
+    def get_scraped_addresses(self, today):
+        if not os.path.isfile(self.file_valid):
+            return set()
+        with open(self.file_valid, newline='', encoding='utf-8') as f:
+            return {row["ScanAddress"].lower() for row in csv.DictReader(f, delimiter='|') if row.get("TodaysDate") == today}
 
     def main(self):
         freeze_support()
@@ -262,14 +405,54 @@ class OpenSeaBot:
         self.banner()
         self.LOGGER.info(f'OpenSeaBot launched')
         thread_counts = self.settings["Settings"]["ThreadCount"]
-        addresses = pd.read_csv(self.file_addresses, index_col=None)
-        addresses = [address["Address"] for address in addresses.iloc]
-        self.get_address_details(addresses)
-        # chunk = round(len(addresses) / thread_counts)
-        # address_chunks = [addresses[x:x + chunk] for x in range(len(addresses))]
-        # with concurrent.futures.ThreadPoolExecutor(max_workers=thread_counts) as executor:
-        #     executor.map(self.get_address_details, address_chunks)
-        # self.LOGGER.info(f'Process completed successfully!')
+        # Read, strip and dedupe the single Address column in one pass, utf-8-sig drops the BOM Excel adds
+        with open(self.file_addresses, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            header = [column.strip() for column in next(reader, [])]
+            if 'Address' not in header:
+                self.LOGGER.error(f'No Address column found in {self.file_addresses}, header: {header}')
+                return
+            column = header.index('Address')
+            # Wallet addresses are case-insensitive, dedupe on the lowercase form and keep the first spelling seen
+            addresses = {}
+            for row in reader:
+                if len(row) > column and row[column].strip():
+                    addresses.setdefault(row[column].strip().lower(), row[column].strip())
+        # Valid.csv doubles as the (date, address) cache, drop addresses already scraped today so interrupted runs can resume
+        today = datetime.now().strftime("%m-%d-%Y")
+        scraped = self.get_scraped_addresses(today=today)
+        addresses = [address for key, address in addresses.items() if key not in scraped]
+        self.LOGGER.info(f'Addresses to scrape: {len(addresses)}')
+        if not addresses:
+            return
+        self.create_valid_file()
+        # Selenium is not thread-safe, so each worker process drives its own browser
+        chunk = max(1, math.ceil(len(addresses) / thread_counts))
+        address_chunks = [addresses[x:x + chunk] for x in range(0, len(addresses), chunk)]
+        # Only the main process writes OpenSeaBot.log, workers log through a queue so rotation stays in one place
+        with multiprocessing.Manager() as manager:
+            log_queue = manager.Queue()
+            valid_lock = manager.Lock()
+            listener = logging.handlers.QueueListener(log_queue, *self.LOGGER.handlers, respect_handler_level=True)
+            listener.start()
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=thread_counts) as executor:
+                    list(executor.map(scrape_addresses, address_chunks, [log_queue] * len(address_chunks),
+                                      [valid_lock] * len(address_chunks)))
+            finally:
+                listener.stop()
+        self.LOGGER.info(f'Process completed successfully!')
+
+
+# Worker entry point, launches one browser and reuses it for the whole chunk
+def scrape_addresses(addresses, log_queue=None, valid_lock=None):
+    bot = OpenSeaBot(log_queue=log_queue, valid_lock=valid_lock)
+    bot.driver = bot.get_driver(proxy=True, headless=True)
+    try:
+        bot.get_address_details(driver=bot.driver, addresses=addresses)
+    finally:
+        # get_address_details may have relaunched the browser, close whichever one is current
+        bot.finish(driver=bot.driver)
 
 
 if __name__ == '__main__':